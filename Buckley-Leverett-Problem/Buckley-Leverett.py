@@ -15,62 +15,105 @@ The Neural Network is constructed as follows:
                        ( x )                                     .                                     (          )
                                                                  .
                                                          ( sigma(t,x,theta) )
+
+Training runs on a single device by default; to shard the collocation points across N GPUs launch with
+                                torchrun --nproc_per_node=N Buckley-Leverett.py
 """
 # Import libraries
+import os
+import math
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.utils.checkpoint import checkpoint
+from torch.nn.parallel import DistributedDataParallel as DDP
 import numpy as np
 import time
 import scipy.io
 
-# Seeds
+# Seed
 torch.manual_seed(123456)
-np.random.seed(123456)
 
 # Generate Neural Network
 class DNN(nn.Module):
 
     def __init__(self):
         super(DNN, self).__init__()
-        self.net = nn.Sequential()                                                 # Define neural network
-        self.net.add_module('Linear_layer_1', nn.Linear(2, 30))                    # First linear layer
-        self.net.add_module('Tanh_layer_1', nn.Tanh())                             # First activation Layer
-
-        for num in range(2, 7):                                                    # Number of layers (2 through 7)
-            self.net.add_module('Linear_layer_%d' % (num), nn.Linear(30, 30))      # Linear layer
-            self.net.add_module('Tanh_layer_%d' % (num), nn.Tanh())                # Activation Layer
-        self.net.add_module('Linear_layer_final', nn.Linear(30, 1))                # Output Layer
-
-    def forward(self, x):
-        return self.net(x)
+        widths = [2] + [30]*6 + [1]                                                # Input, 6 Tanh layers, output layer
+        self.W = nn.ParameterList()                                                # Weights of the linear layers
+        self.b = nn.ParameterList()                                                # Biases of the linear layers
+        for n_in, n_out in zip(widths[:-1], widths[1:]):
+            W = nn.Parameter(torch.empty(n_out, n_in))
+            b = nn.Parameter(torch.empty(n_out))
+            nn.init.kaiming_uniform_(W, a=math.sqrt(5))                            # Same initialization as nn.Linear
+            nn.init.uniform_(b, -1/math.sqrt(n_in), 1/math.sqrt(n_in))
+            self.W.append(W)
+            self.b.append(b)
+        self._ones_cache = {}                                                      # grad_outputs reused across iterations
+
+    # Tensor of ones shaped like ref, allocated once per shape
+    def _ones(self, ref):
+        key = (ref.shape, ref.dtype, ref.device)
+        ones = self._ones_cache.get(key)
+        return ones if ones is not None else self._ones_cache.setdefault(key, torch.ones_like(ref))
+
+    # Layers start, ..., end-1 of the network: fused bias + matmul followed by Tanh, no activation on the output layer
+    def layers(self, h, start, end):
+        for i in range(start, end):
+            h = torch.addmm(self.b[i], h, self.W[i].t())
+            if i < len(self.W) - 1:
+                h = torch.tanh(h)
+        return h
+
+    def forward(self, x, checkpointed=False):
+        h, start = x, 0
+        if checkpointed and torch.is_grad_enabled():                               # Recompute activations in backward
+            for end in (2, 4):                                                     # Two checkpointed segments, rest stored
+                h = checkpoint(self.layers, h, start, end, use_reentrant=False, preserve_rng_state=False)
+                start = end
+        return self.layers(h, start, len(self.W))
 
     # Loss function for PDE
-    def loss_pde(self, x):
-        u = self.net(x)
-        # Gradients and partial derivatives
-        du_g = gradients(u, x)[0]                                  # Gradient [u_t, u_x]
-        u_t, u_x = du_g[:, :1], du_g[:, 1:]                        # Partial derivatives u_t, u_x
-        F = (u**2)/(4*(u**2) + (1-u)**2)
-        DF = gradients(F, x)[0]                                    # Gradient of flux DF
-        F_x = DF[:, 1:]                                            # Partial derivativEe of flux, F(u)_x
-
-        # Loss function for the Euler Equations
-        f = ((u_t + F_x)**2).mean()
+    def loss_pde(self, t, x, amp=True, checkpointed=False):
+        with torch.autocast(x.device.type, dtype=torch.bfloat16, enabled=amp and x.is_cuda, cache_enabled=False):  # Mixed precision on GPU
+            u = self(torch.cat((t, x), 1), checkpointed).float()
+            # Gradients and partial derivatives
+            u_t, u_x = gradients(u, (t, x), self._ones(u))             # Partial derivatives u_t, u_x
+            denom = 4*(u**2) + (1-u)**2                                # Denominator of F(u)
+            dF_du = (2*u*denom - (u**2)*(8*u - 2*(1-u)))/denom**2      # F'(u) by the quotient rule
+            F_x = dF_du*u_x                                            # Partial derivative of flux, F(u)_x = F'(u)u_x
+
+            # Loss function for the Euler Equations
+            f = ((u_t + F_x)**2).mean()
         return f
 
     # Loss function for initial condition
-    def loss_ic(self, x_ic, u_ic):
-        y_ic = self.net(x_ic)                                      # Initial condition
-        u_ic_nn = y_ic[:, 0]
+    def loss_ic(self, x_ic, u_ic, amp=True):
+        with torch.autocast(x_ic.device.type, dtype=torch.bfloat16, enabled=amp and x_ic.is_cuda, cache_enabled=False):  # Mixed precision on GPU
+            y_ic = self(x_ic).float()                                  # Initial condition
+            u_ic_nn = y_ic[:, 0]
 
-        # Loss function for the initial condition
-        loss_ics = ((u_ic_nn - u_ic) ** 2).mean()
+            # Loss function for the initial condition
+            loss_ics = ((u_ic_nn - u_ic) ** 2).mean()
         return loss_ics
 
 
+# Total loss G(theta) in a single forward pass, so that DistributedDataParallel all-reduces the gradients
+class PINNLoss(nn.Module):
+
+    def __init__(self, dnn):
+        super(PINNLoss, self).__init__()
+        self.dnn = dnn
+
+    def forward(self, t_int, x_int, x_ic, u_ic, amp=True, checkpointed=False):
+        return self.dnn.loss_pde(t_int, x_int, amp, checkpointed), self.dnn.loss_ic(x_ic, u_ic, amp)
+
+
 # Calculate gradients using torch.autograd.grad
-def gradients(outputs, inputs):
-    return torch.autograd.grad(outputs, inputs,grad_outputs=torch.ones_like(outputs), create_graph=True)
+def gradients(outputs, inputs, grad_outputs=None):
+    if grad_outputs is None:
+        grad_outputs = torch.ones_like(outputs)
+    return torch.autograd.grad(outputs, inputs,grad_outputs=grad_outputs, create_graph=True)
 
 # Convert torch tensor into np.array
 def to_numpy(input):
@@ -84,94 +127,202 @@ def to_numpy(input):
 
 # Initial conditions
 def IC(x):
-    N = len(x)
-    u_init = np.zeros((x.shape[0]))
-    for i in range(N):
-        if (-0.5 <= x[i] and x[i] <= 0):
-            u_init[i] = 1
-        else:
-            u_init[i] = 0
-    return u_init
+    return ((x >= -0.5) & (x <= 0.0)).float().flatten()                      # u = 1 on [-0.5,0], u = 0 otherwise
 
 # Solve Euler equations using PINNs
 def main():
     # Initialization
-    device = torch.device('cpu')                                          # Run on CPU
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  # Run on GPU if available
+    torch.set_float32_matmul_precision('high')                            # TF32 matmuls for the Adam phase
+    torch.backends.cudnn.allow_tf32 = True                                # TF32 tensor cores for cuDNN
+    distributed = 'WORLD_SIZE' in os.environ                              # Launched with torchrun
+    if distributed:
+        dist.init_process_group('nccl' if torch.cuda.is_available() else 'gloo')
+        local_rank = int(os.environ['LOCAL_RANK'])                        # GPU of this process
+        rank, world_size = dist.get_rank(), dist.get_world_size()         # Shard of this process
+        if torch.cuda.is_available():
+            torch.cuda.set_device(local_rank)
+            device = torch.device(f'cuda:{local_rank}')
+    else:
+        rank, world_size = 0, 1
     lr = 0.0005                                                           # Learning rate
     num_x = 1000                                                          # Number of points in t
     num_t = 1000                                                          # Number of points in x
     num_i_train = 1000                                                    # Random sampled points from IC
-    epochs = 49911                                                        # Number of iterations
-    num_f_train = 11000                                                   # Random sampled points in interior
-    x = np.linspace(-2.625, 2.5,num_x)                                    # Partitioned spatial axis
-    t = np.linspace(0, 1.5, num_t)                                        # Partitioned time axis
-    t_grid, x_grid = np.meshgrid(t, x)                                    # (t,x) in [0,0.2]x[a,b]
-    T = t_grid.flatten()[:, None]                                         # Vectorized t_grid
-    X = x_grid.flatten()[:, None]                                         # Vectorized x_grid
-
-    xs = np.linspace(-1, 1, num_x)                                         # Partitioned spatial axis
-    ts = np.linspace(0, 1.5, num_t)                                       # Partitioned time axis
-    ts_grid, xs_grid = np.meshgrid(ts, xs)                                # (t,x) in [0,0.2]x[a,b]
-    Ts = ts_grid.flatten()[:, None]                                       # Vectorized t_grid
-    Xs = xs_grid.flatten()[:, None]
-
-    id_ic = np.random.choice(num_x, num_i_train, replace=False)           # Random sample numbering for IC
-    id_f = np.random.choice(num_x*num_t, num_f_train, replace=False)      # Random sample numbering for interior
-
-    x_ic = x_grid[id_ic, 0][:, None]                                      # Random x - initial condition
-    t_ic = t_grid[id_ic, 0][:, None]                                      # random t - initial condition
-    x_ic_train = np.hstack((t_ic, x_ic))                                  # Random (x,t) - vectorized
-    u_ic_train = IC(x_ic)                       # Initial condition evaluated at random sample
-
-    x_int = X[:, 0][id_f, None]                                           # Random x - interior
-    t_int = T[:, 0][id_f, None]                                           # Random t - interior
-    x_int_train = np.hstack((t_int, x_int))                               # Random (x,t) - vectorized
-    x_test = np.hstack((Ts, Xs))                                          # Vectorized whole domain
-
-    # Generate tensors
-    x_ic_train = torch.tensor(x_ic_train, dtype=torch.float32).to(device)
-    x_int_train = torch.tensor(x_int_train, requires_grad=True, dtype=torch.float32).to(device)
-    x_test = torch.tensor(x_test, dtype=torch.float32).to(device)
-
-    u_ic_train = torch.tensor(u_ic_train, dtype=torch.float32).to(device)
+    epochs = 5000                                                         # Number of Adam iterations
+    lbfgs_steps = 500                                                     # Number of LBFGS iterations
+    log_every = 200                                                       # Iterations between printed losses
+    num_f_train = 22000                                                   # Random sampled points in interior
+    batch_size = 2048                                                     # Interior points resampled per Adam iteration
+    eval_chunk = 32768                                                    # Test points per inference forward pass
+    warmup = 5                                                            # Eager Adam iterations before CUDA graph capture
+    x = torch.linspace(-2.625, 2.5, num_x, device=device)                 # Partitioned spatial axis
+    t = torch.linspace(0, 1.5, num_t, device=device)                      # Partitioned time axis
+    TX = torch.cartesian_prod(x, t).flip(1)                               # (t,x) grid, x-major as np.meshgrid(t, x)
+    T = TX[:, :1]                                                         # Vectorized t_grid
+    X = TX[:, 1:]                                                         # Vectorized x_grid
+
+    xs = torch.linspace(-1, 1, num_x, device=device)                      # Partitioned spatial axis
+    ts = torch.linspace(0, 1.5, num_t, device=device)                     # Partitioned time axis
+    x_test = torch.cartesian_prod(xs, ts).flip(1)                         # Vectorized whole domain
+
+    id_f = torch.randperm(num_x*num_t, device=device)[:num_f_train]       # Random sample numbering for interior
+    id_f = id_f.tensor_split(world_size)[rank]                            # Interior shard of this process
+
+    # Stratified IC sample: half of the points where u = 1, half where u = 0, shuffled so every shard sees both
+    num_one = num_i_train//2                                              # Points with u = 1
+    x_one = -0.5 + 0.5*torch.rand(num_one, 1, device=device)              # Random x in [-0.5,0]
+    num_zero = num_i_train - num_one                                      # Points with u = 0
+    left = torch.rand(num_zero, 1, device=device) < 2.125/4.625           # Side chosen by length, [-2.625,-0.5) or (0,2.5]
+    r = 1 - torch.rand(num_zero, 1, device=device)                        # Random r in (0,1]
+    x_zero = torch.where(left, -0.5 - 2.125*r, 2.5*r)                     # Random x in [-2.625,-0.5)U(0,2.5]
+    x_ic = torch.cat((x_one, x_zero))[torch.randperm(num_i_train, device=device)]  # Random x - initial condition
+    t_ic = torch.zeros_like(x_ic)                                         # t = 0 - initial condition
+    x_ic_train = torch.cat((t_ic, x_ic), 1)                               # Random (x,t) - vectorized
+    u_ic_train = IC(x_ic)                                                 # Initial condition evaluated at random sample
+
+    x_int_train = X[id_f].requires_grad_()                                # Random x - interior
+    t_int_train = T[id_f].requires_grad_()                                # Random t - interior
+
+    # Shard the IC points across processes
+    x_ic_train = x_ic_train.tensor_split(world_size)[rank]
+    u_ic_train = u_ic_train.tensor_split(world_size)[rank]
+
+    # Shards may differ in size; weighting each shard mean by its share of the points makes the
+    # DDP-averaged gradient that of the global mean
+    w_int = id_f.size(0)*world_size/num_f_train                           # Weight of the fixed interior shard
+    w_ic = x_ic_train.size(0)*world_size/num_i_train                      # Weight of the IC shard
+
+    # Fresh interior batch drawn on the device; every rank draws the same indices and keeps its own shard
+    def sample_interior():
+        id_b = torch.randint(0, num_x*num_t, (batch_size*world_size,), device=device).tensor_split(world_size)[rank]
+        return T[id_b].requires_grad_(), X[id_b].requires_grad_()
 
     # Initialize neural network
     model = DNN().to(device)
+    pinn = PINNLoss(model)
+    if distributed:
+        pinn = DDP(pinn, device_ids=[local_rank] if device.type == 'cuda' else None)
+
+    # Replay the Adam iteration as a CUDA graph on a single GPU; the NCCL all-reduce cannot be captured
+    use_graph = device.type == 'cuda' and not distributed
 
     # Loss and optimizer
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, capturable=use_graph)
+    optimizer_lbfgs = torch.optim.LBFGS(model.parameters(), lr=1.0, max_iter=20, history_size=50,
+                                        tolerance_grad=1e-8, line_search_fn='strong_wolfe')  # Terminal refinement
+
+    # Losses are kept on the device and only copied to the host every log_every iterations
+    loss_buf = []                                                         # Detached [loss, loss_pde, loss_ic] per epoch
+    def log_losses(epoch):
+        history = torch.stack(loss_buf).cpu().tolist()                    # Single device-to-host copy
+        for e, (loss, loss_pde, loss_ic) in enumerate(history, epoch - len(history) + 1):
+            print(f'epoch {e} loss_pde:{loss_pde:.8f}, loss_ic:{loss_ic:.8f}')
+            print(f'epoch {e}: loss {loss:.6f}')
+        loss_buf.clear()
+
+    def record(epoch, losses):
+        loss_buf.append(losses)
+
+        # Print iterations, total loss, loss of PDE and ICs
+        if rank == 0 and (epoch % log_every == 0 or epoch == epochs + lbfgs_steps):
+            log_losses(epoch)
+        elif rank != 0:
+            loss_buf.clear()
 
     # Train PINNs
-    def train(epoch):
+    def train(epoch, optimizer, tx_int):
         model.train()
+        refine = isinstance(optimizer, torch.optim.LBFGS)                             # fp32, checkpointed LBFGS refinement
+        last = {}                                                                     # [loss, loss_pde, loss_ic] of the latest closure call
         def closure():
             optimizer.zero_grad()                                                     # Optimizer
-            loss_pde = model.loss_pde(x_int_train)                                    # Loss function of PDE
-            loss_ic = model.loss_ic(x_ic_train,u_ic_train)   # Loss function of IC
+            loss_pde, loss_ic = pinn(*tx_int, x_ic_train, u_ic_train,
+                                     amp=not refine, checkpointed=refine)             # Loss functions of PDE and IC
+            loss_pde = loss_pde*(w_int if refine else 1.0)                            # Adam batches are equal shards
+            loss_ic = loss_ic*w_ic
             loss = 0.1*loss_pde + 10*loss_ic                                          # Total loss function G(theta)
-
-            # Print iteration, loss of PDE and ICs
-            print(f'epoch {epoch} loss_pde:{loss_pde:.8f}, loss_ic:{loss_ic:.8f}')
             loss.backward()
-            return loss
+
+            # Stash total loss, loss of PDE and ICs for printing
+            losses = torch.stack((loss, loss_pde, loss_ic)).detach()
+            if refine and distributed:                                                # Same line search on every rank
+                dist.all_reduce(losses)
+                losses /= world_size
+            last['losses'] = losses
+            return losses[0]
 
         # Optimize loss function
-        loss = optimizer.step(closure)
-        loss_value = loss.item() if not isinstance(loss, float) else loss
-        # Print total loss
-        print(f'epoch {epoch}: loss {loss_value:.6f}')
+        optimizer.step(closure)
+        record(epoch, last['losses'])
+
+    # Warm up on a side stream, then capture one Adam iteration on static interior inputs
+    def capture_adam_step():
+        side = torch.cuda.Stream()
+        side.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side):
+            for epoch in range(1, warmup+1):
+                train(epoch, optimizer, sample_interior())
+        torch.cuda.current_stream().wait_stream(side)
+
+        static_tx = tuple(v.detach().requires_grad_() for v in sample_interior())   # Static (t,x) inputs
+        graph = torch.cuda.CUDAGraph()
+        optimizer.zero_grad(set_to_none=True)                                       # Gradients allocated by the graph
+        with torch.cuda.graph(graph):
+            loss_pde, loss_ic = pinn(*static_tx, x_ic_train, u_ic_train)
+            loss = 0.1*loss_pde + 10*loss_ic
+            loss.backward()
+            optimizer.step()
+            static_losses = torch.stack((loss, loss_pde, loss_ic)).detach()         # Static [loss, loss_pde, loss_ic]
+        return graph, static_tx, static_losses
 
     # Print CPU
-    print('Start training...')
+    if rank == 0:
+        print('Start training...')
     tic = time.time()
-    for epoch in range(1, epochs+1):
-        train(epoch)
+    if use_graph:
+        graph, static_tx, static_losses = capture_adam_step()
+        for epoch in range(warmup+1, epochs+1):
+            with torch.no_grad():
+                for static, fresh in zip(static_tx, sample_interior()):
+                    static.copy_(fresh)                                   # Fresh batch into the static inputs
+            graph.replay()
+            record(epoch, static_losses.clone())
+    else:
+        for epoch in range(1, epochs+1):
+            train(epoch, optimizer, sample_interior())
+    torch.set_float32_matmul_precision('highest')                         # Full fp32 matmuls for LBFGS, no TF32
+    for epoch in range(epochs+1, epochs+lbfgs_steps+1):
+        train(epoch, optimizer_lbfgs, (t_int_train, x_int_train))                 # Fixed points for the line search
     toc = time.time()
+    if distributed:
+        dist.destroy_process_group()
+    if rank != 0:
+        return
     print(f'Total training time: {toc - tic}')
 
     # Evaluate on the whole computational domain
-    u_pred = to_numpy(model(x_test))
-    scipy.io.savemat('Sod_Shock_Tube.mat', {'x': xs, 't': ts,'u': u_pred[:,0]})
+    model.eval()
+    # Chunks are evaluated on a compute stream and copied into a pinned host buffer on a copy stream,
+    # so the copy of one chunk overlaps the forward pass of the next
+    u_pred = torch.empty(x_test.size(0), 1, pin_memory=device.type == 'cuda')
+    compute = torch.cuda.Stream() if device.type == 'cuda' else None      # Streams are None (no-op) on CPU
+    copy = torch.cuda.Stream() if device.type == 'cuda' else None
+    if compute is not None:
+        compute.wait_stream(torch.cuda.current_stream())                  # x_test was built on the default stream
+    with torch.no_grad():
+        for s in range(0, x_test.size(0), eval_chunk):
+            with torch.cuda.stream(compute):
+                u_chunk = model(x_test[s:s+eval_chunk])
+            if copy is not None:
+                copy.wait_stream(compute)                                 # Event: this chunk's forward is done
+                u_chunk.record_stream(copy)                               # Keep u_chunk alive until copied
+            with torch.cuda.stream(copy):
+                u_pred[s:s+eval_chunk].copy_(u_chunk, non_blocking=True)
+    if copy is not None:
+        copy.synchronize()
+    u_pred = to_numpy(u_pred)
+    scipy.io.savemat('Sod_Shock_Tube.mat', {'x': to_numpy(xs), 't': to_numpy(ts),'u': u_pred[:,0]})
 
 if __name__ == '__main__':
     main()